@@ -0,0 +1,55 @@
+import time
+import argparse
+from PIL import Image
+from main import apply_color_balance, replace_color_pixels
+
+def legacy_replace_color(image, target, replacement):
+    data = image.load()
+    width, height = image.size
+    for x in range(width):
+        for y in range(height):
+            if data[x, y] == target:
+                data[x, y] = replacement
+    return image
+
+def legacy_color_balance(image, red, green, blue):
+    r, g, b = image.split()
+    r = r.point(lambda i: i * red)
+    g = g.point(lambda i: i * green)
+    b = b.point(lambda i: i * blue)
+    return Image.merge("RGB", (r, g, b))
+
+def best_of(repeat, function, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def make_image(width, height):
+    # Noise gives replace_color a realistic, sparse set of matching pixels.
+    return Image.effect_noise((width, height), 64).convert("RGB").point(lambda i: i // 16 * 16)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the vectorized colour kernels against the per-pixel versions they replaced")
+    parser.add_argument("--size", type=int, nargs=2, default=(2000, 1500), metavar=('width', 'height'), help="Size of the synthetic test image")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per kernel; the best time is reported")
+    args = parser.parse_args()
+
+    image = make_image(*args.size)
+    target = image.getpixel((0, 0))
+    replacement = (255, 0, 0)
+
+    legacy_time, legacy_result = best_of(1, legacy_replace_color, image.copy(), target, replacement)
+    new_time, (new_result, count) = best_of(args.repeat, replace_color_pixels, image, target, replacement)
+    assert legacy_result.tobytes() == new_result.tobytes()
+    print(f"replace_color:  legacy {legacy_time * 1000:9.1f} ms  vectorized {new_time * 1000:9.1f} ms  ({legacy_time / new_time:.0f}x, {count} pixels)")
+
+    legacy_time, legacy_result = best_of(args.repeat, legacy_color_balance, image, 1.2, 0.9, 0.7)
+    new_time, new_result = best_of(args.repeat, apply_color_balance, image, 1.2, 0.9, 0.7)
+    assert legacy_result.tobytes() == new_result.tobytes()
+    print(f"color_balance:  legacy {legacy_time * 1000:9.1f} ms  vectorized {new_time * 1000:9.1f} ms  ({legacy_time / new_time:.1f}x)")
+
+if __name__ == "__main__":
+    main()
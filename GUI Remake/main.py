@@ -1,7 +1,217 @@
 import tkinter as tk
-from tkinter import filedialog, simpledialog, messagebox, colorchooser, font as tkfont
+from tkinter import ttk, filedialog, simpledialog, messagebox, colorchooser, font as tkfont
 from PIL import Image, ImageTk, ImageOps, ImageEnhance, ImageDraw, ImageFont, ImageFilter, ImageColor
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+import functools
+import numpy as np
+
+def color_balance_lut(bands, red, green, blue):
+    # One lookup table for all bands, so the whole adjustment is a single
+    # point() pass. Alpha is left untouched.
+    factors = np.array([red, green, blue] + [1.0] * (len(bands) - 3), dtype=np.float64)
+    lut = np.clip(np.rint(np.arange(256)[None, :] * factors[:, None]), 0, 255).astype(np.uint8)
+    return lut.ravel().tolist()
+
+def apply_color_balance(image, red, green, blue):
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    return image.point(color_balance_lut(image.getbands(), red, green, blue))
+
+def normalize_color(color, mode):
+    # getpixel returns an int for single-band images and a 4-tuple with alpha;
+    # reduce either to the tuple of colour channels for this mode.
+    if isinstance(color, int):
+        color = (color,)
+    return tuple(color[:1] if mode == "L" else color[:3])
+
+def replace_color_pixels(image, target, replacement, tolerance=0):
+    # Replaces every pixel whose colour channels lie within `tolerance`
+    # (Euclidean distance) of `target`. Alpha is preserved.
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    pixels = np.array(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, None]
+    channels = 1 if image.mode == "L" else 3
+    target = np.array(normalize_color(target, image.mode), dtype=np.int32)
+    color = pixels[:, :, :channels].astype(np.int32)
+    if tolerance > 0:
+        difference = color - target
+        mask = np.einsum("ijk,ijk->ij", difference, difference) <= tolerance * tolerance
+    else:
+        mask = np.all(color == target, axis=2)
+    pixels[mask, :channels] = np.array(replacement[:channels], dtype=np.uint8)
+    if image.mode == "L":
+        pixels = pixels[:, :, 0]
+    return Image.fromarray(pixels, image.mode), int(mask.sum())
+
+def pack_image(image):
+    return (image.mode, image.size, image.getpalette() if image.mode == "P" else None, dict(image.info), zlib.compress(image.tobytes(), 1))
+
+def unpack_image(packed):
+    mode, size, palette, info, data = packed
+    image = Image.frombytes(mode, size, zlib.decompress(data))
+    if palette:
+        image.putpalette(palette)
+    image.info.update(info)
+    return image
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_style, font_size):
+    # Fonts are reused across text edits instead of being reopened and parsed
+    # each time; one that cannot be found falls back to Pillow's built-in
+    # font at the same size.
+    try:
+        return ImageFont.truetype(font_style, font_size)
+    except OSError:
+        return ImageFont.load_default(font_size)
+
+class HistoryStore:
+    # Undo/redo history bounded by a byte budget rather than an entry count.
+    # Global edits keep a zlib-compressed snapshot of the whole image, local
+    # edits keep only the region they touch, and a crop keeps the pixels it
+    # removed (the kept area is blanked so it compresses to almost nothing).
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.undo_entries = deque()
+        self.redo_entries = deque()
+        self.memory_bytes = 0
+
+    @staticmethod
+    def entry_size(entry):
+        return len(entry[-1][-1]) if entry[0] != "recrop" else 0
+
+    def clear(self):
+        self.undo_entries.clear()
+        self.redo_entries.clear()
+        self.memory_bytes = 0
+
+    def push(self, entries, entry):
+        entries.append(entry)
+        self.memory_bytes += self.entry_size(entry)
+        self.evict()
+
+    def evict(self):
+        # Oldest undo steps go first, then the furthest redo steps, but the
+        # most recent step is always kept even if it alone exceeds the budget.
+        while self.memory_bytes > self.budget_bytes and len(self.undo_entries) + len(self.redo_entries) > 1:
+            entries = self.undo_entries if self.undo_entries else self.redo_entries
+            self.memory_bytes -= self.entry_size(entries.popleft())
+
+    def set_budget(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.evict()
+
+    def record_snapshot(self, image):
+        self.discard_redo()
+        self.push(self.undo_entries, ("snapshot", pack_image(image)))
+
+    def record_region(self, image, box):
+        box = self.clamp_box(image, box)
+        if box:
+            self.discard_redo()
+            self.push(self.undo_entries, ("region", box, pack_image(image.crop(box))))
+
+    def record_crop(self, image, box):
+        self.discard_redo()
+        self.push(self.undo_entries, self.crop_entry(image, box))
+
+    def discard_redo(self):
+        while self.redo_entries:
+            self.memory_bytes -= self.entry_size(self.redo_entries.pop())
+
+    @staticmethod
+    def clamp_box(image, box):
+        left, top, right, bottom = box
+        box = (max(0, int(left)), max(0, int(top)), min(image.width, int(right) + 1), min(image.height, int(bottom) + 1))
+        return box if box[0] < box[2] and box[1] < box[3] else None
+
+    @staticmethod
+    def crop_entry(image, box):
+        removed = image.copy()
+        removed.paste(0, box)
+        return ("crop", box, pack_image(removed))
+
+    def restore(self, entry, image):
+        # Returns the restored image and the entry that reverses the restore.
+        if entry[0] == "snapshot":
+            return unpack_image(entry[1]), ("snapshot", pack_image(image))
+        if entry[0] == "region":
+            box = entry[1]
+            inverse = ("region", box, pack_image(image.crop(box)))
+            image.paste(unpack_image(entry[2]), box[:2])
+            return image, inverse
+        if entry[0] == "crop":
+            restored = unpack_image(entry[2])
+            restored.paste(image, entry[1][:2])
+            return restored, ("recrop", entry[1])
+        return image.crop(entry[1]), self.crop_entry(image, entry[1])
+
+    def undo(self, image):
+        if not self.undo_entries:
+            return None
+        entry = self.undo_entries.pop()
+        self.memory_bytes -= self.entry_size(entry)
+        image, inverse = self.restore(entry, image)
+        self.push(self.redo_entries, inverse)
+        return image
+
+    def redo(self, image):
+        if not self.redo_entries:
+            return None
+        entry = self.redo_entries.pop()
+        self.memory_bytes -= self.entry_size(entry)
+        image, inverse = self.restore(entry, image)
+        self.push(self.undo_entries, inverse)
+        return image
+
+def scale_size(size, scale):
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+class PreviewEngine:
+    # Keeps a mip pyramid of successive halvings of the full image so any
+    # zoom level is resampled from the nearest larger level instead of the
+    # full resolution, and the view currently on screen. Edits are applied
+    # to the view first for instant feedback.
+    def __init__(self):
+        self.levels = []
+        self.view = None
+        self.scale = 1.0
+
+    def build(self, image):
+        self.levels = self.build_levels(image)
+
+    @staticmethod
+    def build_levels(image):
+        level = image if image.mode in ("L", "RGB", "RGBA") else image.convert("RGBA")
+        levels = [level]
+        while min(level.size) > 64:
+            level = level.reduce(2)
+            levels.append(level)
+        return levels
+
+    def render(self, canvas_size, zoom):
+        full_width, full_height = self.levels[0].size
+        self.scale = min(canvas_size[0] / full_width, canvas_size[1] / full_height, 1.0) * zoom
+        index = 0
+        while index + 1 < len(self.levels) and self.levels[index + 1].width >= full_width * self.scale:
+            index += 1
+        size = scale_size((full_width, full_height), self.scale)
+        level = self.levels[index]
+        self.view = level if level.size == size else level.resize(size, Image.BILINEAR)
+        return self.view
+
+class EditJob:
+    def __init__(self, edit, message):
+        self.edit = edit
+        self.message = message
+        self.cancelled = False
+        self.future = None
+        self.previous = None
+        self.result = None
+        self.levels = None
 
 class ImageEditorApp:
     def __init__(self, root):
@@ -18,8 +228,19 @@ class ImageEditorApp:
         self.crop_end_x = None
         self.crop_end_y = None
         self.color_picker_start = None
-        self.undo_stack = deque()
-        self.redo_stack = deque()
+        self.history = HistoryStore(256 * 1024 * 1024)
+        self.preview = PreviewEngine()
+        self.zoom = 1.0
+        # A single worker applies edits to the full-resolution image in the
+        # order they were made; the Tk thread only touches the preview.
+        self.commit_executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = deque()
+        self.jobs_total = 0
+        self.jobs_done = 0
+        self.polling = False
+        # Actions waiting in finish_commits for the queued edits to land.
+        self.after_commits = deque()
+        self.running_after_commits = False
         self.draw_tool = None
         self.shape_start_x = None
         self.shape_start_y = None
@@ -28,6 +249,7 @@ class ImageEditorApp:
         self.line_start_x = None
         self.line_start_y = None
         self.selected_color = "#000000"
+        self.replace_tolerance = 0
 
         self.create_widgets()
 
@@ -72,84 +294,214 @@ class ImageEditorApp:
         edit_menu.add_command(label="Draw Line", command=self.initiate_line_draw)
         edit_menu.add_command(label="Undo", command=self.undo)
         edit_menu.add_command(label="Redo", command=self.redo)
+        edit_menu.add_command(label="History Budget", command=self.set_history_budget)
+        edit_menu.add_command(label="Cancel Pending Edits", command=self.cancel_jobs)
+
+        view_menu = tk.Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="View", menu=view_menu)
+        view_menu.add_command(label="Zoom In", command=lambda: self.set_zoom(self.zoom * 2))
+        view_menu.add_command(label="Zoom Out", command=lambda: self.set_zoom(self.zoom / 2))
+        view_menu.add_command(label="Fit to Window", command=lambda: self.set_zoom(1.0))
 
         self.canvas = tk.Canvas(self.root, bg='white')
         self.canvas.pack(fill=tk.BOTH, expand=True)
 
-        self.status_bar = tk.Label(self.root, text="No image loaded", bd=1, relief=tk.SUNKEN, anchor=tk.W)
-        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        status_frame = tk.Frame(self.root)
+        status_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.progress_bar = ttk.Progressbar(status_frame, mode="determinate", length=150)
+        self.progress_bar.pack(side=tk.RIGHT)
+        self.status_bar = tk.Label(status_frame, text="No image loaded", bd=1, relief=tk.SUNKEN, anchor=tk.W)
+        self.status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.root.bind("<Escape>", lambda event: self.cancel_jobs())
 
     def update_status(self, message):
-        self.status_bar.config(text=message)
+        history_mb = self.history.memory_bytes / (1024 * 1024)
+        self.status_bar.config(text=f"{message}    [History: {history_mb:.1f} MB]")
 
     def open_image(self):
         file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp")])
         if file_path:
-            self.image = Image.open(file_path)
-            self.original_image = self.image.copy()
-            self.undo_stack.clear()
-            self.redo_stack.clear()
-            self.display_image()
-            self.update_status(f"Opened: {file_path}")
-
-    def display_image(self):
-        if self.image:
-            self.tk_image = ImageTk.PhotoImage(self.image)
-            if self.image_label:
-                self.image_label.destroy()
+            self.finish_commits(lambda: self.load_image(file_path))
+
+    def load_image(self, file_path):
+        self.image = Image.open(file_path)
+        self.original_image = self.image.copy()
+        self.history.clear()
+        self.display_image()
+        self.update_status(f"Opened: {file_path}")
+
+    def canvas_size(self):
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        return (width, height) if width > 1 and height > 1 else (800, 600)
+
+    def display_image(self, rebuild=True):
+        if self.image:
+            if rebuild:
+                self.preview.build(self.image)
+            self.preview.render(self.canvas_size(), self.zoom)
+            self.show_view()
+
+    def show_view(self):
+        self.tk_image = ImageTk.PhotoImage(self.preview.view)
+        if self.image_label:
+            self.image_label.configure(image=self.tk_image)
+        else:
             self.image_label = tk.Label(self.canvas, image=self.tk_image)
             self.image_label.pack()
 
+    def set_zoom(self, zoom):
+        if self.image and not self.jobs:
+            self.zoom = min(max(zoom, 0.125), 8.0)
+            self.display_image(rebuild=False)
+            self.update_status(f"Zoom: {self.zoom * 100:.0f}%")
+
+    def to_image_coords(self, x, y):
+        return int(x / self.preview.scale), int(y / self.preview.scale)
+
+    def apply_edit(self, edit, message):
+        # edit(image, scale) is run on the on-screen view right away, with
+        # scale set so size-dependent parameters look right, and then queued
+        # for the full-resolution image.
+        if self.after_commits and not self.running_after_commits:
+            # Stays behind the actions still waiting for earlier edits.
+            self.after_commits.append(lambda: self.apply_edit(edit, message))
+            return
+        self.preview.view = edit(self.preview.view, self.preview.scale)
+        self.show_view()
+        job = EditJob(edit, message)
+        job.previous = self.jobs[-1] if self.jobs else None
+        job.future = self.commit_executor.submit(self.run_job, job)
+        self.jobs.append(job)
+        self.jobs_total += 1
+        if not self.polling:
+            self.polling = True
+            self.root.after(50, self.poll_jobs)
+        self.update_progress()
+
+    def run_job(self, job):
+        # Runs on the worker thread and only computes: each edit starts from
+        # the result of the one queued before it, and finish_job commits the
+        # result on the Tk thread unless the job was cancelled by then.
+        previous, job.previous = job.previous, None
+        if job.cancelled:
+            return
+        source = previous.result if previous and not previous.cancelled else self.image
+        job.result = source
+        result = job.edit(source, 1.0)
+        job.result = result
+        if self.jobs and job is self.jobs[-1]:
+            # Only the newest result is ever shown, so only its pyramid is
+            # built, and off the Tk thread.
+            job.levels = self.preview.build_levels(result)
+
+    def poll_jobs(self):
+        job = None
+        while self.jobs and self.jobs[0].future.done():
+            job = self.finish_job(self.jobs.popleft())
+        if self.jobs:
+            self.update_progress()
+            self.root.after(50, self.poll_jobs)
+            return
+        self.polling = False
+        if job is not None:
+            if job.levels and not job.cancelled:
+                self.preview.levels = job.levels
+                self.display_image(rebuild=False)
+            else:
+                self.display_image()
+            self.update_status("Edits cancelled" if job.cancelled else job.message)
+            self.jobs_total = self.jobs_done = 0
+            self.progress_bar["value"] = 0
+        self.run_after_commits()
+
+    def finish_job(self, job):
+        self.jobs_done += 1
+        if job.future.cancelled() or job.cancelled:
+            return job
+        if job.future.exception():
+            messagebox.showerror("Edit Failed", str(job.future.exception()))
+        elif job.result is not None:
+            self.push_undo()
+            self.image = job.result
+        return job
+
+    def update_progress(self):
+        self.progress_bar["maximum"] = self.jobs_total
+        self.progress_bar["value"] = self.jobs_done
+        if self.jobs[-1].cancelled:
+            self.update_status("Cancelling pending edits...")
+        elif self.after_commits:
+            self.update_status(f"Waiting for pending edits ({self.jobs_done + 1} of {self.jobs_total})...")
+        else:
+            self.update_status(f"{self.jobs[-1].message} (preview, applying edit {self.jobs_done + 1} of {self.jobs_total})")
+
+    def cancel_jobs(self):
+        # Drops every queued edit; the preview reverts to the full image once
+        # the edit currently running (if any) has finished.
+        for job in self.jobs:
+            job.cancelled = True
+            job.future.cancel()
+        if self.jobs:
+            self.update_progress()
+
+    def finish_commits(self, then):
+        # Anything that reads or edits the full image directly goes through
+        # here: then() runs once every queued edit has landed. The wait is
+        # left to poll_jobs, so the window stays live and Escape can still
+        # cancel the edits.
+        if self.jobs:
+            self.after_commits.append(then)
+            self.update_progress()
+        else:
+            then()
+
+    def run_after_commits(self):
+        # In the order they were asked for; one that queues an edit of its
+        # own leaves the rest waiting for that edit too.
+        self.running_after_commits = True
+        try:
+            while self.after_commits and not self.jobs:
+                self.after_commits.popleft()()
+        finally:
+            self.running_after_commits = False
+
     def resize_image(self):
         if self.image:
             width = simpledialog.askinteger("Resize", "Enter new width:")
             height = simpledialog.askinteger("Resize", "Enter new height:")
             if width and height:
-                self.push_undo()
-                self.image = self.image.resize((width, height))
-                self.display_image()
-                self.update_status(f"Resized to {width}x{height}")
+                self.apply_edit(lambda image, scale: image.resize(scale_size((width, height), scale)), f"Resized to {width}x{height}")
 
     def rotate_image(self):
         if self.image:
             angle = simpledialog.askinteger("Rotate", "Enter rotation angle:")
             if angle is not None:
-                self.push_undo()
-                self.image = self.image.rotate(angle)
-                self.display_image()
-                self.update_status(f"Rotated by {angle} degrees")
+                self.apply_edit(lambda image, scale: image.rotate(angle), f"Rotated by {angle} degrees")
 
     def apply_grayscale(self):
         if self.image:
-            self.push_undo()
-            self.image = ImageOps.grayscale(self.image)
-            self.display_image()
-            self.update_status("Applied grayscale")
+            self.apply_edit(lambda image, scale: ImageOps.grayscale(image), "Applied grayscale")
 
     def increase_contrast(self):
         if self.image:
-            enhancer = ImageEnhance.Contrast(self.image)
             factor = simpledialog.askfloat("Contrast", "Enter contrast factor (1.0 for no change):", minvalue=0.0)
             if factor is not None:
-                self.push_undo()
-                self.image = enhancer.enhance(factor)
-                self.display_image()
-                self.update_status(f"Contrast increased by factor {factor}")
+                self.apply_edit(lambda image, scale: ImageEnhance.Contrast(image).enhance(factor), f"Contrast increased by factor {factor}")
 
     def reset_image(self):
         if self.original_image:
-            self.push_undo()
-            self.image = self.original_image.copy()
-            self.display_image()
-            self.update_status("Image reset")
+            self.apply_edit(lambda image, scale: self.original_image.resize(scale_size(self.original_image.size, scale)) if scale != 1 else self.original_image.copy(), "Image reset")
 
     def save_image(self):
         if self.image:
-            file_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg;*.jpeg"), ("All files", "*.*")])
-            if file_path:
-                self.image.save(file_path)
-                messagebox.showinfo("Save Image", "Image saved successfully!")
-                self.update_status(f"Saved: {file_path}")
+            self.finish_commits(self.write_image)
+
+    def write_image(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png"), ("JPEG files", "*.jpg;*.jpeg"), ("All files", "*.*")])
+        if file_path:
+            self.image.save(file_path)
+            messagebox.showinfo("Save Image", "Image saved successfully!")
+            self.update_status(f"Saved: {file_path}")
 
     def initiate_crop(self):
         self.canvas.bind("<ButtonPress-1>", self.on_crop_start)
@@ -176,14 +528,18 @@ class ImageEditorApp:
 
     def crop_image(self):
         if self.image and self.crop_start_x is not None and self.crop_end_x is not None:
-            left = min(self.crop_start_x, self.crop_end_x)
-            top = min(self.crop_start_y, self.crop_end_y)
-            right = max(self.crop_start_x, self.crop_end_x)
-            bottom = max(self.crop_start_y, self.crop_end_y)
-            self.push_undo()
-            self.image = self.image.crop((left, top, right, bottom))
-            self.display_image()
-            self.update_status(f"Cropped to box ({left}, {top}, {right}, {bottom})")
+            start = (min(self.crop_start_x, self.crop_end_x), min(self.crop_start_y, self.crop_end_y))
+            end = (max(self.crop_start_x, self.crop_end_x), max(self.crop_start_y, self.crop_end_y))
+
+            def commit():
+                left, top = self.to_image_coords(*start)
+                right, bottom = self.to_image_coords(*end)
+                self.history.record_crop(self.image, (left, top, right, bottom))
+                self.image = self.image.crop((left, top, right, bottom))
+                self.display_image()
+                self.update_status(f"Cropped to box ({left}, {top}, {right}, {bottom})")
+
+            self.finish_commits(commit)
             self.canvas.unbind("<ButtonPress-1>")
             self.canvas.unbind("<B1-Motion>")
             self.canvas.unbind("<ButtonRelease-1>")
@@ -201,46 +557,35 @@ class ImageEditorApp:
             font_style = simpledialog.askstring("Font Style", "Enter font style (default: arial.ttf):", initialvalue=self.font_style)
             font_size = simpledialog.askinteger("Font Size", "Enter font size (default: 20):", initialvalue=self.font_size)
             if text and x is not None and y is not None and color:
-                self.push_undo()
-                draw = ImageDraw.Draw(self.image)
-                font = ImageFont.truetype(font_style, font_size)
-                draw.text((x, y), text, fill=color, font=font)
-                self.display_image()
-                self.update_status(f"Added text '{text}' at ({x}, {y})")
+                def commit():
+                    font = load_font(font_style, font_size)
+                    draw = ImageDraw.Draw(self.image)
+                    self.history.record_region(self.image, draw.textbbox((x, y), text, font=font))
+                    draw.text((x, y), text, fill=color, font=font)
+                    self.display_image()
+                    self.update_status(f"Added text '{text}' at ({x}, {y})")
+
+                self.finish_commits(commit)
 
     def apply_blur(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.filter(ImageFilter.BLUR)
-            self.display_image()
-            self.update_status("Applied blur filter")
+            self.apply_edit(lambda image, scale: image.filter(ImageFilter.BLUR), "Applied blur filter")
 
     def apply_sharpen(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.filter(ImageFilter.SHARPEN)
-            self.display_image()
-            self.update_status("Applied sharpen filter")
+            self.apply_edit(lambda image, scale: image.filter(ImageFilter.SHARPEN), "Applied sharpen filter")
 
     def adjust_brightness(self):
         if self.image:
             brightness = simpledialog.askfloat("Brightness", "Enter brightness factor (1.0 for no change):", minvalue=0.0)
             if brightness is not None:
-                self.push_undo()
-                enhancer = ImageEnhance.Brightness(self.image)
-                self.image = enhancer.enhance(brightness)
-                self.display_image()
-                self.update_status(f"Brightness adjusted by factor {brightness}")
+                self.apply_edit(lambda image, scale: ImageEnhance.Brightness(image).enhance(brightness), f"Brightness adjusted by factor {brightness}")
 
     def adjust_contrast(self):
         if self.image:
             contrast = simpledialog.askfloat("Contrast", "Enter contrast factor (1.0 for no change):", minvalue=0.0)
             if contrast is not None:
-                self.push_undo()
-                enhancer = ImageEnhance.Contrast(self.image)
-                self.image = enhancer.enhance(contrast)
-                self.display_image()
-                self.update_status(f"Contrast adjusted by factor {contrast}")
+                self.apply_edit(lambda image, scale: ImageEnhance.Contrast(image).enhance(contrast), f"Contrast adjusted by factor {contrast}")
 
     def adjust_color_balance(self):
         if self.image:
@@ -248,14 +593,7 @@ class ImageEditorApp:
             green = simpledialog.askfloat("Color Balance", "Enter green balance (1.0 for no change):", minvalue=0.0)
             blue = simpledialog.askfloat("Color Balance", "Enter blue balance (1.0 for no change):", minvalue=0.0)
             if red is not None and green is not None and blue is not None:
-                self.push_undo()
-                r, g, b = self.image.split()
-                r = r.point(lambda i: i * red)
-                g = g.point(lambda i: i * green)
-                b = b.point(lambda i: i * blue)
-                self.image = Image.merge("RGB", (r, g, b))
-                self.display_image()
-                self.update_status(f"Adjusted color balance: red={red}, green={green}, blue={blue}")
+                self.apply_edit(lambda image, scale: apply_color_balance(image, red, green, blue), f"Adjusted color balance: red={red}, green={green}, blue={blue}")
 
     def initiate_color_picker(self):
         if self.image:
@@ -263,100 +601,75 @@ class ImageEditorApp:
 
     def pick_color(self, event):
         if self.image:
-            x, y = event.x, event.y
-            color = self.image.getpixel((x, y))
-            self.color_picker_start = color
-            color_hex = "#%02x%02x%02x" % color
-            self.selected_color = color_hex
-            self.update_status(f"Picked color: {color_hex}")
+            def commit():
+                x, y = self.to_image_coords(event.x, event.y)
+                color = self.image.getpixel((x, y))
+                if self.image.mode not in ("L", "RGB", "RGBA"):
+                    color = self.image.convert("RGB").getpixel((x, y))
+                self.color_picker_start = color
+                channels = normalize_color(color, self.image.mode)
+                color_hex = "#%02x%02x%02x" % (channels * 3 if len(channels) == 1 else channels)
+                self.selected_color = color_hex
+                self.update_status(f"Picked color: {color_hex}")
+
+            self.finish_commits(commit)
             self.canvas.unbind("<Button-1>")
 
     def replace_color(self):
-        if self.image and self.color_picker_start:
+        if self.image and self.color_picker_start is not None:
             new_color = colorchooser.askcolor()[1]
             if new_color:
-                new_color_rgb = ImageColor.getrgb(new_color)
-                r, g, b = self.color_picker_start
-                data = self.image.load()
-                width, height = self.image.size
-                for x in range(width):
-                    for y in range(height):
-                        if data[x, y] == (r, g, b):
-                            data[x, y] = new_color_rgb
-                self.push_undo()
-                self.display_image()
-                self.update_status(f"Replaced color {self.color_picker_start} with {new_color_rgb}")
+                def commit():
+                    tolerance = simpledialog.askinteger("Replace Color", "Enter color match tolerance (0 for exact match):", initialvalue=self.replace_tolerance, minvalue=0, maxvalue=442)
+                    if tolerance is None:
+                        return
+                    self.replace_tolerance = tolerance
+                    new_color_rgb = ImageColor.getrgb(new_color)
+                    replacement = (ImageColor.getcolor(new_color, "L"),) if self.image.mode == "L" else new_color_rgb
+                    target = self.color_picker_start
+                    self.apply_edit(lambda image, scale: replace_color_pixels(image, target, replacement, tolerance)[0], f"Replaced color {target} with {new_color_rgb}")
+
+                self.finish_commits(commit)
 
     def apply_sepia(self):
         if self.image:
-            self.push_undo()
-            sepia = ImageOps.colorize(self.image.convert("L"), "#704214", "#C0C0C0")
-            self.image = sepia
-            self.display_image()
-            self.update_status("Applied sepia filter")
+            self.apply_edit(lambda image, scale: ImageOps.colorize(image.convert("L"), "#704214", "#C0C0C0"), "Applied sepia filter")
 
     def invert_colors(self):
         if self.image:
-            self.push_undo()
-            self.image = ImageOps.invert(self.image)
-            self.display_image()
-            self.update_status("Inverted colors")
+            self.apply_edit(lambda image, scale: ImageOps.invert(image), "Inverted colors")
 
     def flip_horizontal(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.transpose(Image.FLIP_LEFT_RIGHT)
-            self.display_image()
-            self.update_status("Flipped horizontally")
+            self.apply_edit(lambda image, scale: image.transpose(Image.FLIP_LEFT_RIGHT), "Flipped horizontally")
 
     def flip_vertical(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.transpose(Image.FLIP_TOP_BOTTOM)
-            self.display_image()
-            self.update_status("Flipped vertically")
+            self.apply_edit(lambda image, scale: image.transpose(Image.FLIP_TOP_BOTTOM), "Flipped vertically")
 
     def rotate_90_cw(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.rotate(-90, expand=True)
-            self.display_image()
-            self.update_status("Rotated 90 degrees clockwise")
+            self.apply_edit(lambda image, scale: image.rotate(-90, expand=True), "Rotated 90 degrees clockwise")
 
     def rotate_90_ccw(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.rotate(90, expand=True)
-            self.display_image()
-            self.update_status("Rotated 90 degrees counterclockwise")
+            self.apply_edit(lambda image, scale: image.rotate(90, expand=True), "Rotated 90 degrees counterclockwise")
 
     def apply_emboss(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.filter(ImageFilter.EMBOSS)
-            self.display_image()
-            self.update_status("Applied emboss filter")
+            self.apply_edit(lambda image, scale: image.filter(ImageFilter.EMBOSS), "Applied emboss filter")
 
     def apply_edge_enhance(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.filter(ImageFilter.EDGE_ENHANCE)
-            self.display_image()
-            self.update_status("Applied edge enhance filter")
+            self.apply_edit(lambda image, scale: image.filter(ImageFilter.EDGE_ENHANCE), "Applied edge enhance filter")
 
     def apply_edge_enhance_more(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.filter(ImageFilter.EDGE_ENHANCE_MORE)
-            self.display_image()
-            self.update_status("Applied edge enhance more filter")
+            self.apply_edit(lambda image, scale: image.filter(ImageFilter.EDGE_ENHANCE_MORE), "Applied edge enhance more filter")
 
     def apply_gaussian_blur_more(self):
         if self.image:
-            self.push_undo()
-            self.image = self.image.filter(ImageFilter.GaussianBlur(radius=5))
-            self.display_image()
-            self.update_status("Applied gaussian blur more filter")
+            self.apply_edit(lambda image, scale: image.filter(ImageFilter.GaussianBlur(radius=5 * scale)), "Applied gaussian blur more filter")
 
     def initiate_rectangle_draw(self):
         self.canvas.bind("<ButtonPress-1>", self.on_rectangle_start)
@@ -376,11 +689,18 @@ class ImageEditorApp:
     def on_rectangle_end(self, event):
         if self.image:
             self.canvas.delete("rectangle")
-            end_x, end_y = event.x, event.y
-            draw = ImageDraw.Draw(self.image)
-            draw.rectangle([self.shape_start_x, self.shape_start_y, end_x, end_y], outline="blue", width=3)
-            self.display_image()
-            self.update_status(f"Drew rectangle from ({self.shape_start_x}, {self.shape_start_y}) to ({end_x}, {end_y})")
+            start = (self.shape_start_x, self.shape_start_y)
+
+            def commit():
+                start_x, start_y = self.to_image_coords(*start)
+                end_x, end_y = self.to_image_coords(event.x, event.y)
+                self.push_shape_undo(start_x, start_y, end_x, end_y, 3)
+                draw = ImageDraw.Draw(self.image)
+                draw.rectangle([start_x, start_y, end_x, end_y], outline="blue", width=3)
+                self.display_image()
+                self.update_status(f"Drew rectangle from ({start_x}, {start_y}) to ({end_x}, {end_y})")
+
+            self.finish_commits(commit)
             self.canvas.unbind("<ButtonPress-1>")
             self.canvas.unbind("<B1-Motion>")
             self.canvas.unbind("<ButtonRelease-1>")
@@ -403,11 +723,18 @@ class ImageEditorApp:
     def on_ellipse_end(self, event):
         if self.image:
             self.canvas.delete("ellipse")
-            end_x, end_y = event.x, event.y
-            draw = ImageDraw.Draw(self.image)
-            draw.ellipse([self.shape_start_x, self.shape_start_y, end_x, end_y], outline="green", width=3)
-            self.display_image()
-            self.update_status(f"Drew ellipse from ({self.shape_start_x}, {self.shape_start_y}) to ({end_x}, {end_y})")
+            start = (self.shape_start_x, self.shape_start_y)
+
+            def commit():
+                start_x, start_y = self.to_image_coords(*start)
+                end_x, end_y = self.to_image_coords(event.x, event.y)
+                self.push_shape_undo(start_x, start_y, end_x, end_y, 3)
+                draw = ImageDraw.Draw(self.image)
+                draw.ellipse([start_x, start_y, end_x, end_y], outline="green", width=3)
+                self.display_image()
+                self.update_status(f"Drew ellipse from ({start_x}, {start_y}) to ({end_x}, {end_y})")
+
+            self.finish_commits(commit)
             self.canvas.unbind("<ButtonPress-1>")
             self.canvas.unbind("<B1-Motion>")
             self.canvas.unbind("<ButtonRelease-1>")
@@ -430,33 +757,58 @@ class ImageEditorApp:
     def on_line_end(self, event):
         if self.image:
             self.canvas.delete("line")
-            end_x, end_y = event.x, event.y
-            draw = ImageDraw.Draw(self.image)
-            draw.line([self.line_start_x, self.line_start_y, end_x, end_y], fill="red", width=3)
-            self.display_image()
-            self.update_status(f"Drew line from ({self.line_start_x}, {self.line_start_y}) to ({end_x}, {end_y})")
+            start = (self.line_start_x, self.line_start_y)
+
+            def commit():
+                start_x, start_y = self.to_image_coords(*start)
+                end_x, end_y = self.to_image_coords(event.x, event.y)
+                self.push_shape_undo(start_x, start_y, end_x, end_y, 3)
+                draw = ImageDraw.Draw(self.image)
+                draw.line([start_x, start_y, end_x, end_y], fill="red", width=3)
+                self.display_image()
+                self.update_status(f"Drew line from ({start_x}, {start_y}) to ({end_x}, {end_y})")
+
+            self.finish_commits(commit)
             self.canvas.unbind("<ButtonPress-1>")
             self.canvas.unbind("<B1-Motion>")
             self.canvas.unbind("<ButtonRelease-1>")
 
     def push_undo(self):
-        self.undo_stack.append(self.image.copy())
-        if len(self.undo_stack) > 20:
-            self.undo_stack.popleft()
+        self.history.record_snapshot(self.image)
+
+    def push_shape_undo(self, x0, y0, x1, y1, width):
+        self.history.record_region(self.image, (min(x0, x1) - width, min(y0, y1) - width, max(x0, x1) + width, max(y0, y1) + width))
+
+    def set_history_budget(self):
+        budget = simpledialog.askinteger("History Budget", "Enter undo history budget in MB:", initialvalue=self.history.budget_bytes // (1024 * 1024), minvalue=1)
+        if budget:
+            # The worker pushes snapshots while edits land, so the store is
+            # only changed once they have.
+            def commit():
+                self.history.set_budget(budget * 1024 * 1024)
+                self.update_status(f"Undo history budget set to {budget} MB")
+
+            self.finish_commits(commit)
 
     def undo(self):
-        if self.undo_stack:
-            self.redo_stack.append(self.image.copy())
-            self.image = self.undo_stack.pop()
+        self.finish_commits(self.undo_now)
+
+    def undo_now(self):
+        image = self.history.undo(self.image) if self.image else None
+        if image:
+            self.image = image
             self.display_image()
             self.update_status("Undid last action")
         else:
             self.update_status("Nothing to undo")
 
     def redo(self):
-        if self.redo_stack:
-            self.undo_stack.append(self.image.copy())
-            self.image = self.redo_stack.pop()
+        self.finish_commits(self.redo_now)
+
+    def redo_now(self):
+        image = self.history.redo(self.image) if self.image else None
+        if image:
+            self.image = image
             self.display_image()
             self.update_status("Redid last undone action")
         else:
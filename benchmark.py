@@ -0,0 +1,211 @@
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import PIL
+from PIL import Image
+from main import compile_command_sequence, execute_plan, encode_with_options, resolve_format
+
+MODES = ('L', 'RGB', 'RGBA', 'I;16')
+SIZES = ((512, 512), (2048, 1536), (4096, 3072))
+
+def single_commands(size, assets):
+    width, height = size
+    return {
+        'resize': ('resize', width // 2, height // 2),
+        'rotate': ('rotate', 30),
+        'grayscale': ('grayscale',),
+        'crop': ('crop', width // 4, height // 4, width * 3 // 4, height * 3 // 4),
+        'flip': ('flip', 'horizontal'),
+        'brightness': ('brightness', 1.2),
+        'blur': ('blur', 2.0),
+        'blur_large': ('blur', 40.0),
+        'blur_large_exact': ('blur', 40.0, 'gaussian'),
+        'blur_box': ('blur', 40.0, 'box'),
+        'contrast': ('contrast', 1.3),
+        'sharpen': ('sharpen',),
+        'edge_enhance': ('edge_enhance',),
+        'color': ('color', 1.2),
+        'saturation': ('saturation', 0.8),
+        'text': ('text', 'Benchmark', (20, 20), 20, 'white'),
+        'watermark': ('watermark', assets['watermark'], (10, 10)),
+        'equalize': ('equalize',),
+        'invert': ('invert',),
+        'blend': ('blend', assets['blend'], 0.5),
+        'color_transform': ('color_transform', [0.9, 0.1, 0.0, 0.0, 0.1, 0.8, 0.1, 0.0, 0.0, 0.1, 0.9, 0.0]),
+        'format': ('format', 'PNG'),
+        'format_jpeg': ('format', 'JPEG'),
+        'format_webp': ('format', 'WEBP'),
+    }
+
+def chains(size):
+    width, height = size
+    return {
+        'chain:thumbnail': [('resize', width // 8, height // 8), ('sharpen',)],
+        'chain:enhance': [('brightness', 1.1), ('contrast', 1.2), ('color', 1.1), ('saturation', 1.1), ('invert',)],
+        'chain:crop_flip': [('resize', width // 2, height // 2), ('crop', 0, 0, width // 4, height // 4), ('flip', 'vertical')],
+    }
+
+def make_image(mode, size):
+    # Deterministic content with both smooth gradients and noise, so
+    # filters and encoders see something closer to a photo than a flat fill.
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40)
+    if mode == 'L':
+        return Image.blend(gradient, noise, 0.3)
+    if mode == 'I;16':
+        return Image.blend(gradient, noise, 0.3).convert('I').point(lambda value: value * 256).convert('I;16')
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_180)))
+    if mode == 'RGBA':
+        image.putalpha(gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+    return image
+
+def make_assets(directory):
+    assets = {'watermark': os.path.join(directory, 'watermark.png'), 'blend': os.path.join(directory, 'blend.png')}
+    watermark = make_image('RGBA', (128, 64))
+    watermark.save(assets['watermark'])
+    make_image('RGB', (640, 480)).save(assets['blend'])
+    return assets
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_case(name, mode, size, commands, repeat):
+    # Runs in a fresh process so the peak RSS growth belongs to this case
+    # alone; Pillow allocates pixel data outside the Python allocator, so
+    # tracemalloc would not see it.
+    image = make_image(mode, size)
+    image.load()
+    baseline_rss = peak_rss_bytes()
+    # A trailing format step is timed the way the CLI saves, through the
+    # encoder into memory, rather than run as a command.
+    format = resolve_format(commands[-1][1]) if commands[-1][0] == 'format' else None
+    plan = compile_command_sequence(commands[:-1] if format else commands)
+
+    def run(source):
+        result = execute_plan(source, plan)
+        result.load()
+        if format:
+            encode_with_options(result, io.BytesIO(), format, {})
+
+    timings = []
+    try:
+        # One untimed run first so plugin imports and lazy setup are excluded.
+        run(image.copy())
+        for _ in range(repeat):
+            source = image.copy()
+            start = time.perf_counter()
+            run(source)
+            timings.append(time.perf_counter() - start)
+    except Exception as e:
+        return {'name': name, 'mode': mode, 'size': list(size), 'error': f"{type(e).__name__}: {e}"}
+    seconds = min(timings)
+    megapixels = size[0] * size[1] / 1e6
+    return {
+        'name': name,
+        'mode': mode,
+        'size': list(size),
+        'megapixels': megapixels,
+        'seconds': seconds,
+        'mp_per_s': megapixels / seconds if seconds else None,
+        'peak_rss_mb': max(0, peak_rss_bytes() - baseline_rss) / (1024 * 1024),
+    }
+
+def run_benchmarks(modes, sizes, repeat, only=None):
+    results = []
+    context = multiprocessing.get_context('fork' if sys.platform != 'win32' else 'spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        assets = make_assets(directory)
+        for size in sizes:
+            cases = {name: [command] for name, command in single_commands(size, assets).items()}
+            cases.update(chains(size))
+            for mode in modes:
+                for name, commands in cases.items():
+                    if only and name not in only:
+                        continue
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        result = executor.submit(run_case, name, mode, size, commands, repeat).result()
+                    results.append(result)
+                    print_result(result)
+    return results
+
+def case_key(result):
+    return f"{result['name']}|{result['mode']}|{result['size'][0]}x{result['size'][1]}"
+
+def print_result(result):
+    label = f"{result['name']:<18} {result['mode']:<5} {result['size'][0]:>5}x{result['size'][1]:<5}"
+    if 'error' in result:
+        print(f"{label}  skipped ({result['error']})")
+    else:
+        print(f"{label}  {result['seconds'] * 1000:9.2f} ms  {result['mp_per_s']:9.1f} MP/s  {result['peak_rss_mb']:8.1f} MB peak")
+
+def compare_to_baseline(results, baseline, threshold):
+    # A case regresses when its throughput falls more than `threshold`
+    # (a fraction) below the baseline run of the same case.
+    previous = {case_key(result): result for result in baseline['results'] if 'error' not in result}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if 'error' in result or not before or not before['mp_per_s']:
+            continue
+        ratio = result['mp_per_s'] / before['mp_per_s']
+        if ratio < 1 - threshold:
+            regressions.append((case_key(result), before['mp_per_s'], result['mp_per_s'], ratio))
+    return regressions
+
+def parse_size(value):
+    width, _, height = value.lower().partition('x')
+    return (int(width), int(height))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark every execute_command operation and common chains",
+        epilog="Examples:\n\n"
+               "  Save a baseline:\n"
+               "    python benchmark.py --output baseline.json\n\n"
+               "  Compare against it after an upgrade:\n"
+               "    python benchmark.py --output current.json --baseline baseline.json --threshold 0.15",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--modes", nargs='+', default=list(MODES), choices=MODES, help="Image modes to benchmark")
+    parser.add_argument("--sizes", nargs='+', type=parse_size, default=list(SIZES), metavar='WxH', help="Synthetic image sizes to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest is reported")
+    parser.add_argument("--only", nargs='+', metavar='name', help="Only run the named operations or chains")
+    parser.add_argument("--output", type=str, metavar='path', help="Write results as JSON")
+    parser.add_argument("--baseline", type=str, metavar='path', help="Compare against a previously saved JSON result")
+    parser.add_argument("--threshold", type=float, default=0.1, metavar='fraction', help="Throughput drop that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.modes, args.sizes, args.repeat, args.only)
+    report = {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.threshold)
+        if regressions:
+            print("\nRegressions:")
+            for key, before, after, ratio in regressions:
+                print(f"{key}: {before:.1f} -> {after:.1f} MP/s ({(1 - ratio) * 100:.0f}% slower)")
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import os
+
+from PIL import Image, ImageChops
+
+from main import FRAME_DEFAULTS, compile_command_sequence, process_opened_image, write_image_atomically
+
+
+def make_pages(path, mode='L', count=3):
+    pages = [Image.new(mode, (40, 30), 40 * (index + 1)) for index in range(count)]
+    pages[0].save(path, save_all=True, append_images=pages[1:])
+    return pages
+
+
+def test_multi_page_tiff_round_trip(tmp_path):
+    source = os.path.join(tmp_path, 'pages.tif')
+    output = os.path.join(tmp_path, 'out.tif')
+    pages = make_pages(source)
+    with Image.open(source) as image:
+        processed = process_opened_image(image, compile_command_sequence([('flip', 'horizontal')]), 0, FRAME_DEFAULTS, 'TIFF')
+        write_image_atomically(processed, output)
+    with Image.open(output) as result:
+        assert result.n_frames == len(pages)
+        for index, page in enumerate(pages):
+            result.seek(index)
+            assert ImageChops.difference(result.convert(page.mode), page).getbbox() is None
+
+
+def test_pages_keep_their_mode(tmp_path):
+    for mode in ('L', 'I;16', 'RGB'):
+        source = os.path.join(tmp_path, f"{mode.replace(';', '')}.tif")
+        pages = make_pages(source, mode)
+        if mode == 'I;16':
+            pages = [page.point(lambda value: value * 200) for page in pages]
+            pages[0].save(source, save_all=True, append_images=pages[1:])
+        with Image.open(source) as image:
+            processed = process_opened_image(image, [], 0, FRAME_DEFAULTS, 'TIFF')
+        assert [frame.mode for frame in processed.frames] == [mode] * len(pages)
+        for frame, page in zip(processed.frames, pages):
+            assert frame.tobytes() == page.tobytes()
+
+
+def test_single_frame_output_takes_first_frame(tmp_path):
+    source = os.path.join(tmp_path, 'pages.tif')
+    pages = make_pages(source)
+    with Image.open(source) as image:
+        processed = process_opened_image(image, [], 0, FRAME_DEFAULTS, 'JPEG')
+        assert isinstance(processed, Image.Image)
+        assert processed.tobytes() == pages[0].tobytes()
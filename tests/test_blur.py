@@ -0,0 +1,60 @@
+import random
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+from main import blur_image, choose_blur_algorithm
+
+
+def make_photo(size=(1200, 900)):
+    # Smooth gradients with mild noise and a few hard-edged shapes, large
+    # enough for auto to downsample.
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 12)
+    image = Image.merge('RGB', (gradient, Image.blend(gradient.transpose(Image.Transpose.ROTATE_90).resize(size), noise, 0.5), noise))
+    draw = ImageDraw.Draw(image)
+    generator = random.Random(0)
+    for _ in range(8):
+        x, y = generator.randrange(size[0]), generator.randrange(size[1])
+        draw.rectangle((x, y, x + generator.randrange(20, 200), y + generator.randrange(20, 200)), fill=tuple(generator.randrange(256) for _ in range(3)))
+    return image
+
+
+def blur_error(image, radius, algorithm):
+    difference = ImageChops.difference(blur_image(image, radius, algorithm), image.filter(ImageFilter.GaussianBlur(radius)))
+    return max(difference.tobytes()), max(ImageStat.Stat(difference).mean)
+
+
+IMAGE = make_photo()
+RADII = (2, 5, 20, 40, 80, 150, 225)
+
+
+def test_auto_picks_downsample_only_for_large_radii():
+    assert [choose_blur_algorithm(IMAGE, radius) for radius in RADII] == ['gaussian'] * 2 + ['downsample'] * 5
+    assert choose_blur_algorithm(IMAGE.resize((600, 450)), 40) == 'gaussian'
+
+
+def test_gaussian_is_exact():
+    for radius in RADII:
+        assert blur_error(IMAGE, radius, 'gaussian') == (0, 0)
+
+
+def test_auto_stays_close_to_gaussian():
+    for radius in RADII:
+        maximum, mean = blur_error(IMAGE, radius, 'auto')
+        if choose_blur_algorithm(IMAGE, radius) == 'gaussian':
+            assert (maximum, mean) == (0, 0)
+        else:
+            assert maximum <= 14 and mean < 0.5, radius
+
+
+def test_downsample_stays_close_to_gaussian():
+    for radius in RADII:
+        maximum, mean = blur_error(IMAGE, radius, 'downsample')
+        assert maximum <= 14 and mean < 0.5, radius
+
+
+def test_box_error_bounds():
+    for radius in RADII:
+        maximum, mean = blur_error(IMAGE, radius, 'box')
+        assert maximum <= 45, radius
+        assert mean <= (1 if radius <= 5 else 4), radius
@@ -0,0 +1,62 @@
+import random
+
+from PIL import Image, ImageChops
+
+from main import compile_command_sequence, execute_command, execute_plan
+
+
+def make_image(mode, size=(61, 43), seed=0):
+    generator = random.Random(seed)
+    image = Image.frombytes('RGB', size, bytes(generator.randrange(256) for _ in range(size[0] * size[1] * 3)))
+    return image.convert(mode)
+
+
+def run_chain(image, commands):
+    for command in commands:
+        image = execute_command(image, command)
+    return image
+
+
+def max_difference(first, second):
+    assert first.size == second.size and first.mode == second.mode
+    return max(ImageChops.difference(first, second).tobytes())
+
+
+POINT_CHAINS = [
+    [('brightness', 1.2), ('contrast', 1.3), ('invert',), ('contrast', 0.7)],
+    [('contrast', 1.5), ('brightness', 0.8), ('contrast', 1.4)],
+    [('invert',), ('contrast', 0.4), ('brightness', 1.7)],
+]
+MATRIX_CHAINS = [
+    [('color', 1.3), ('saturation', 0.8), ('brightness', 0.9), ('contrast', 1.1)],
+    [('saturation', 0.5), ('contrast', 1.2)],
+]
+GEOMETRY_CHAINS = [
+    [('flip', 'horizontal'), ('resize', 30, 20)],
+    [('rotate', 180), ('resize', 37, 19), ('flip', 'vertical')],
+    [('resize', 40, 30), ('crop', 3, 4, 35, 28)],
+    [('crop', 2, 2, 55, 40), ('crop', 5, 7, 50, 30), ('flip', 'horizontal')],
+]
+
+
+def test_default_plan_matches_step_by_step():
+    for mode in ('L', 'RGB'):
+        for seed, commands in enumerate(POINT_CHAINS + MATRIX_CHAINS + GEOMETRY_CHAINS):
+            image = make_image(mode, seed=seed)
+            assert max_difference(execute_plan(image, compile_command_sequence(commands)), run_chain(image, commands)) == 0, commands
+
+
+def test_point_tables_match_on_random_chains():
+    generator = random.Random(2)
+    for seed in range(200):
+        commands = [generator.choice([('brightness', generator.uniform(0.3, 1.8)), ('contrast', generator.uniform(0.3, 1.8)), ('invert',)]) for _ in range(generator.randint(2, 4))]
+        image = make_image('RGB', (generator.randint(3, 40), generator.randint(3, 40)), seed)
+        assert max_difference(execute_plan(image, compile_command_sequence(commands)), run_chain(image, commands)) == 0, commands
+
+
+def test_approximate_plan_stays_close():
+    image = make_image('RGB')
+    for commands in MATRIX_CHAINS:
+        assert max_difference(execute_plan(image, compile_command_sequence(commands, approximate=True)), run_chain(image, commands)) <= 4
+    for commands in GEOMETRY_CHAINS:
+        assert max_difference(execute_plan(image, compile_command_sequence(commands, approximate=True)), run_chain(image, commands)) <= 1
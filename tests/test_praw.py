@@ -0,0 +1,44 @@
+import os
+
+from PIL import Image, ImageChops
+
+from main import RAW_HEADER, RAW_HEADER_SIZE, RAW_MAGIC, StripReader
+
+
+def test_rgb_is_mapped(tmp_path):
+    path = os.path.join(tmp_path, 'image.praw')
+    source = Image.radial_gradient('L').resize((97, 61)).convert('RGB')
+    source.save(path)
+    assert os.path.getsize(path) == RAW_HEADER_SIZE + source.width * source.height * 4
+    with Image.open(path) as image:
+        image.load()
+        assert image.mode == 'RGB' and image.map is not None
+        assert ImageChops.difference(image, source).getbbox() is None
+        image.paste((1, 2, 3), (0, 0, 4, 4))
+        assert image.getpixel((0, 0)) == (1, 2, 3)
+
+
+def test_unpadded_rgb_still_reads(tmp_path):
+    path = os.path.join(tmp_path, 'legacy.praw')
+    source = Image.radial_gradient('L').resize((5, 4)).convert('RGB')
+    with open(path, 'wb') as raw_file:
+        raw_file.write(RAW_HEADER.pack(RAW_MAGIC, 1, 0, b'RGB', 5, 4, 15).ljust(RAW_HEADER_SIZE, b'\0') + source.tobytes())
+    with Image.open(path) as image:
+        assert ImageChops.difference(image, source).getbbox() is None
+
+
+def test_planar_file_reads_strip_by_strip(tmp_path, capsys):
+    path = os.path.join(tmp_path, 'planar.praw')
+    gradient = Image.radial_gradient('L').resize((97, 61))
+    for mode in ('RGB', 'CMYK'):
+        source = Image.merge(mode, [gradient.rotate(90 * index) for index in range(len(mode))])
+        source.save(path, layout='planar')
+        reader = StripReader(path)
+        try:
+            assert reader.file is not None
+            for top in range(0, source.height, 7):
+                bottom = min(top + 7, source.height)
+                assert reader.read(top, bottom).tobytes() == source.crop((0, top, source.width, bottom)).tobytes()
+        finally:
+            reader.close()
+    assert 'compressed' not in capsys.readouterr().out
@@ -0,0 +1,51 @@
+import os
+
+from PIL import Image, ImageChops
+
+from main import TiffStripWriter
+
+
+def write_strips(path, image, rows_per_strip, bigtiff):
+    writer = TiffStripWriter(path, image.mode, image.size, rows_per_strip, bigtiff)
+    for top in range(0, image.height, rows_per_strip):
+        writer.write(image.crop((0, top, image.width, min(top + rows_per_strip, image.height))))
+    writer.close()
+
+
+def test_classic_and_bigtiff_round_trip(tmp_path):
+    source = Image.radial_gradient('L').resize((97, 61))
+    for mode in ('L', 'RGB', 'RGBA'):
+        image = source.convert(mode)
+        for bigtiff in (False, True):
+            for rows_per_strip in (7, image.height):
+                path = os.path.join(tmp_path, f"{mode}-{bigtiff}-{rows_per_strip}.tif")
+                write_strips(path, image, rows_per_strip, bigtiff)
+                with open(path, 'rb') as output_file:
+                    assert output_file.read(4) == (b'II+\x00' if bigtiff else b'II*\x00')
+                with Image.open(path) as result:
+                    assert result.mode == mode and result.size == image.size
+                    assert ImageChops.difference(result, image).getbbox() is None
+
+
+def test_large_outputs_default_to_bigtiff(tmp_path):
+    small = TiffStripWriter(os.path.join(tmp_path, 'small.tif'), 'RGB', (30000, 30000), 64)
+    large = TiffStripWriter(os.path.join(tmp_path, 'large.tif'), 'RGB', (40000, 40000), 64)
+    small.file.close()
+    large.file.close()
+    assert not small.bigtiff
+    assert large.bigtiff
+
+
+def test_sixteen_bit_and_extra_band_modes_round_trip(tmp_path):
+    gradient = Image.radial_gradient('L').resize((97, 61))
+    images = {
+        'I;16': gradient.convert('I').point(lambda value: value * 250).convert('I;16'),
+        'LA': Image.merge('LA', (gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))),
+        'CMYK': gradient.convert('CMYK'),
+    }
+    for mode, image in images.items():
+        path = os.path.join(tmp_path, f"{mode.replace(';', '')}.tif")
+        write_strips(path, image, 7, False)
+        with Image.open(path) as result:
+            assert result.mode == mode
+            assert result.tobytes() == image.tobytes()